@@ -5,7 +5,7 @@ Payment Tracker Bot v3
 - Balance reconciliation
 - Context view/edit via Telegram
 """
-import os, json, logging, base64
+import os, re, json, logging, base64, asyncio, random, functools
 from datetime import datetime, time, date as date_type, timedelta
 from pathlib import Path
 import httpx
@@ -16,6 +16,15 @@ try:
     HAS_PDF = True
 except ImportError:
     HAS_PDF = False
+try:
+    import orjson
+    def _json_loads(s): return orjson.loads(s)
+    def _json_dumps(obj, indent=False) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+except ImportError:  # orjson is a speed-up, not a requirement
+    def _json_loads(s): return json.loads(s)
+    def _json_dumps(obj, indent=False) -> str:
+        return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (Application, MessageHandler, CommandHandler,
@@ -26,13 +35,20 @@ ANTHROPIC_KEY = os.environ["ANTHROPIC_KEY"]
 MY_CHAT_ID    = int(os.environ["MY_CHAT_ID"])
 MORNING_HOUR  = int(os.environ.get("MORNING_HOUR", "9"))
 
-DATA_FILE    = Path("data/messages.json")
+DATA_FILE    = Path("data/messages.ndjson")  # append-only, one JSON object per line
 EXCEL_FILE   = Path("Agent_Model_v2.xlsx")
 CONTEXT_FILE = Path("data/context.txt")
 PENDING_FILE = Path("data/pending_update.json")  # stores parsed data awaiting confirmation
 
 logging.basicConfig(level=logging.INFO)
 
+def _save_wb(wb):
+    """Save to a temp file then os.replace — readers never see a half-written
+    xlsx, and a crash mid-save leaves the old file intact."""
+    tmp = EXCEL_FILE.with_suffix(".tmp")
+    wb.save(tmp)
+    os.replace(tmp, EXCEL_FILE)
+
 def _ensure_settings_usdt():
     """Add USDT=1.0 to Settings FX table if not present."""
     if not EXCEL_FILE.exists(): return
@@ -47,11 +63,10 @@ def _ensure_settings_usdt():
             if not ws.cell(r, 1).value:
                 ws.cell(r, 1).value = "USDT"
                 ws.cell(r, 2).value = 1.0
-                from openpyxl.styles import Font, Alignment
                 ws.cell(r, 1).font = Font(name="Arial", size=9)
                 ws.cell(r, 2).font = Font(name="Arial", size=9)
                 ws.cell(r, 2).alignment = Alignment(horizontal="right")
-                wb.save(EXCEL_FILE)
+                _save_wb(wb)
                 log.info("Added USDT=1.0 to Settings FX table")
                 return
     except Exception as e:
@@ -86,29 +101,54 @@ TYPE_BG = {"Deposit": GREEN, "Payment": WHITE, "Cash Out": ORANGE,
 STAT_BG = {"✅ Paid": GREEN, "⏳ Pending": YELLOW,
            "⚠ Partial/Check": ORANGE, "❓ Clarify": RED}
 
+# openpyxl style objects are immutable and shareable — build each combination
+# once and assign by reference instead of 4 allocations per styled cell
+_STYLE_CACHE = {}
+
 def sc(cell, bg=WHITE, bold=False, sz=9, fc="000000", num=None,
        align="left", wrap=False):
-    cell.font      = Font(name="Arial", bold=bold, size=sz, color=fc)
-    cell.fill      = PatternFill("solid", fgColor=bg)
-    cell.alignment = Alignment(horizontal=align, vertical="center", wrap_text=wrap)
-    cell.border    = B()
+    key = (bg, bold, sz, fc, align, wrap)
+    styles = _STYLE_CACHE.get(key)
+    if styles is None:
+        styles = (Font(name="Arial", bold=bold, size=sz, color=fc),
+                  PatternFill("solid", fgColor=bg),
+                  Alignment(horizontal=align, vertical="center", wrap_text=wrap),
+                  B())
+        _STYLE_CACHE[key] = styles
+    cell.font, cell.fill, cell.alignment, cell.border = styles
     if num: cell.number_format = num
 
 # ── Context ───────────────────────────────────────────────────────────────────
+# Context file cache — invalidated on mtime so manual edits are picked up
+_ctx_cache = {"mtime": -1, "text": ""}
+
 def load_context() -> str:
     CONTEXT_FILE.parent.mkdir(exist_ok=True)
-    return CONTEXT_FILE.read_text(encoding="utf-8") if CONTEXT_FILE.exists() else ""
+    try:
+        st = CONTEXT_FILE.stat()
+    except FileNotFoundError:
+        return ""
+    if st.st_mtime_ns != _ctx_cache["mtime"]:
+        _ctx_cache["text"]  = CONTEXT_FILE.read_text(encoding="utf-8")
+        _ctx_cache["mtime"] = st.st_mtime_ns
+    return _ctx_cache["text"]
 
 def save_context(text: str):
     CONTEXT_FILE.parent.mkdir(exist_ok=True)
     CONTEXT_FILE.write_text(text, encoding="utf-8")
+    _ctx_cache["text"]  = text
+    _ctx_cache["mtime"] = CONTEXT_FILE.stat().st_mtime_ns
 
 def update_context_after_update(new_info: str):
     """Append new findings to context file."""
     ctx = load_context()
     ts  = datetime.now().strftime("%d.%m.%Y %H:%M")
-    ctx += f"\n\n--- ОБНОВЛЕНИЕ {ts} ---\n{new_info}"
-    save_context(ctx)
+    block = f"\n\n--- ОБНОВЛЕНИЕ {ts} ---\n{new_info}"
+    CONTEXT_FILE.parent.mkdir(exist_ok=True)
+    with CONTEXT_FILE.open("a", encoding="utf-8") as f:
+        f.write(block)
+    _ctx_cache["text"]  = ctx + block
+    _ctx_cache["mtime"] = CONTEXT_FILE.stat().st_mtime_ns
 
 
 CHAT_HISTORY_FILE = Path("data/chat_history.json")
@@ -116,13 +156,13 @@ MAX_HISTORY = 8  # keep last 8 exchanges
 
 def load_chat_history():
     CHAT_HISTORY_FILE.parent.mkdir(exist_ok=True)
-    return json.loads(CHAT_HISTORY_FILE.read_text(encoding="utf-8")) if CHAT_HISTORY_FILE.exists() else []
+    return _json_loads(CHAT_HISTORY_FILE.read_bytes()) if CHAT_HISTORY_FILE.exists() else []
 
 def save_chat_history(history: list):
     # Keep only last MAX_HISTORY exchanges
     if len(history) > MAX_HISTORY * 2:
         history = history[-(MAX_HISTORY * 2):]
-    CHAT_HISTORY_FILE.write_text(json.dumps(history, ensure_ascii=False, indent=2), encoding="utf-8")
+    CHAT_HISTORY_FILE.write_text(_json_dumps(history), encoding="utf-8")
 
 def clear_chat_history():
     if CHAT_HISTORY_FILE.exists(): CHAT_HISTORY_FILE.unlink()
@@ -130,8 +170,9 @@ def clear_chat_history():
 def get_recent_transactions_with_rows(n=10) -> str:
     """Get last N transactions with row numbers for chat editing."""
     if not EXCEL_FILE.exists(): return ""
+    wb = None
     try:
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        wb = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
         ws = wb["Transactions"]
         rows = []
         for i, row in enumerate(ws.iter_rows(min_row=5, max_col=12, values_only=True), start=5):
@@ -141,14 +182,20 @@ def get_recent_transactions_with_rows(n=10) -> str:
             lines.append(f"row={i} | {row[0]} | {row[1]} | {str(row[2] or '')[:40]} | {row[4]} {row[5]} | K={row[10]}")
         return "\n".join(lines)
     except: return ""
+    finally:
+        if wb is not None: wb.close()
 
 def get_excel_summary() -> str:
-    """Get compact Excel state for chat context."""
+    """Get compact Excel state for chat context. One workbook parse, one
+    pass per sheet via snapshot_excel."""
     lines = []
-    bal = get_balance_from_excel()
+    try:
+        bal, (pending, usd_total, tbc_count), unknown = snapshot_excel()
+    except Exception as e:
+        log.error(f"get_excel_summary: {e}")
+        bal, pending, usd_total, tbc_count, unknown = None, [], 0.0, 0, []
     if bal:
         lines.append(f"Баланс агента: ${bal[0]:,.2f} USD (на {bal[1]})")
-    pending, usd_total, tbc_count = get_pending_invoices()
     if pending:
         lines.append(f"Pending инвойсов: {len(pending)}")
         lines.extend(pending[:5])
@@ -156,7 +203,6 @@ def get_excel_summary() -> str:
             lines.append(f"  ...и ещё {len(pending)-5}")
         tbc_note = f" + {tbc_count} с суммой TBC" if tbc_count else ""
         lines.append(f"  Итого к оплате: ~${usd_total:,.0f} USD{tbc_note}")
-    unknown = get_unknown_transactions()
     if unknown:
         lines.append(f"Неизвестных транзакций: {len(unknown)}")
     queue = load_messages()
@@ -165,33 +211,69 @@ def get_excel_summary() -> str:
     return "\n".join(lines) if lines else "Excel не найден"
 
 # ── Message store ─────────────────────────────────────────────────────────────
+# NDJSON: save_message appends one line instead of re-serializing the whole
+# queue, so a day of forwarded messages stays O(1) per append.
+# The parsed queue is kept in memory after the first read — handlers call
+# load_messages several times per update and shouldn't re-parse the file.
+_msg_cache = None  # list | None
+
 def load_messages():
+    global _msg_cache
+    if _msg_cache is not None:
+        return _msg_cache
     DATA_FILE.parent.mkdir(exist_ok=True)
-    return json.loads(DATA_FILE.read_text(encoding="utf-8")) if DATA_FILE.exists() else []
+    if not DATA_FILE.exists():
+        _msg_cache = []
+        return _msg_cache
+    with DATA_FILE.open("r", encoding="utf-8") as f:
+        _msg_cache = [_json_loads(line) for line in f if line.strip()]
+    return _msg_cache
 
 def save_message(d):
-    msgs = load_messages(); msgs.append(d)
-    DATA_FILE.write_text(json.dumps(msgs, ensure_ascii=False, indent=2), encoding="utf-8")
+    DATA_FILE.parent.mkdir(exist_ok=True)
+    with DATA_FILE.open("a", encoding="utf-8") as f:
+        f.write(_json_dumps(d) + "\n")
+    load_messages().append(d)
 
 def clear_messages():
-    DATA_FILE.write_text("[]", encoding="utf-8")
+    global _msg_cache
+    DATA_FILE.write_text("", encoding="utf-8")
+    _msg_cache = []
 
 def _fmt(msgs):
+    # Runs on every Claude call — single pass, one dict lookup per key
     lines = []
+    ap = lines.append
     for m in msgs:
-        line = f"[{m['date']}] {m.get('sender','?')}:"
-        if m.get("text"): line += f" {m['text']}"
-        if m.get("file"): line += f" [файл: {m['file']}]"
-        if m.get("pdf_content"):
-            line += f"\n  [СОДЕРЖИМОЕ PDF {m['file']}]:\n  {m['pdf_content'][:2000]}"
-        lines.append(line)
+        get  = m.get
+        text = get("text"); file_n = get("file"); pdf = get("pdf_content")
+        line = f"[{m['date']}] {get('sender', '?')}:"
+        if text:   line += f" {text}"
+        if file_n: line += f" [файл: {file_n}]"
+        if pdf:    line += f"\n  [СОДЕРЖИМОЕ PDF {file_n}]:\n  {pdf[:2000]}"
+        ap(line)
     return "\n".join(lines)
 
 def _clean_json(raw: str) -> str:
-    """Strip markdown fences and leading 'json' tag from Claude's response."""
-    raw = raw.strip().strip("```").strip()
-    if raw.startswith("json"): raw = raw[4:].strip()
-    return raw
+    """Extract the first balanced JSON object from Claude's response.
+    Bracket-balancing survives markdown fences, stray backticks and prose
+    around the JSON — fence-stripping lost the whole update on any of those."""
+    start = raw.find("{")
+    if start == -1:
+        return raw.strip()
+    depth = 0; in_str = False; esc = False
+    for i in range(start, len(raw)):
+        c = raw[i]
+        if in_str:
+            if esc: esc = False
+            elif c == "\\": esc = True
+            elif c == '"': in_str = False
+        elif c == '"': in_str = True
+        elif c == "{": depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0: return raw[start:i + 1]
+    return raw[start:].strip()
 
 def _build_multimodal_content(msgs: list) -> list:
     """
@@ -253,48 +335,125 @@ def _build_multimodal_content(msgs: list) -> list:
 
 # ── Pending confirmation store ────────────────────────────────────────────────
 def save_pending(data: dict):
-    PENDING_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    PENDING_FILE.write_text(_json_dumps(data), encoding="utf-8")
 
 def load_pending() -> dict:
-    return json.loads(PENDING_FILE.read_text(encoding="utf-8")) if PENDING_FILE.exists() else {}
+    return _json_loads(PENDING_FILE.read_bytes()) if PENDING_FILE.exists() else {}
 
 def clear_pending():
     if PENDING_FILE.exists(): PENDING_FILE.unlink()
 
 # ── Excel read ────────────────────────────────────────────────────────────────
-def get_balance_from_excel():
+_xlsx_cache = None  # (mtime_ns, size, bytes) — reuse bytes for unchanged sends
+
+def get_excel_bytes() -> bytes:
+    """Raw xlsx bytes for send_document, cached until the file changes."""
+    global _xlsx_cache
+    st  = EXCEL_FILE.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    if _xlsx_cache and _xlsx_cache[:2] == key:
+        return _xlsx_cache[2]
+    data = EXCEL_FILE.read_bytes()
+    _xlsx_cache = (*key, data)
+    return data
+
+
+def _open_wb_readonly():
+    """Streaming read-only workbook for the get_* helpers, None if no Excel yet."""
     if not EXCEL_FILE.exists(): return None
+    return load_workbook(EXCEL_FILE, read_only=True, data_only=True)
+
+
+# Query results memoized per on-disk workbook version — repeated commands
+# between writes answer from memory, any save changes the key and drops it all
+_read_cache = {"key": None, "vals": {}}
+
+def _excel_key():
+    try:
+        st = EXCEL_FILE.stat()
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+def _memo_get(key, name):
+    if key is not None and _read_cache["key"] == key and name in _read_cache["vals"]:
+        return True, _read_cache["vals"][name]
+    return False, None
+
+def _memo_store(key, name, value):
+    if key is None: return
+    if _read_cache["key"] != key:
+        _read_cache["key"] = key
+        _read_cache["vals"] = {}
+    _read_cache["vals"][name] = value
+
+
+def get_balance_from_excel(wb=None):
+    # Callers that query several helpers in a row pass one shared workbook
+    # instead of paying the xlsx parse per helper
+    own = wb is None
+    key = _excel_key() if own else None
+    hit, cached = _memo_get(key, "balance")
+    if hit: return cached
     try:
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        if own: wb = _open_wb_readonly()
+        if wb is None: return None
         ws = wb["Transactions"]
         last_bal = last_date = None
-        for row in ws.iter_rows(min_row=5, max_col=11, values_only=True):
-            if row[10] is not None and isinstance(row[10], (int, float)):
-                last_bal  = row[10]
-                last_date = row[0]
-        return (last_bal, last_date) if last_bal else None
+        # The last numeric balance sits at the tail — scan a bounded window
+        # from the end first and fall back to the full sheet only when empty
+        tail = max(5, ws.max_row - 200)
+        windows = [(tail, None)] + ([(5, tail - 1)] if tail > 5 else [])
+        for lo, hi in windows:
+            for row in ws.iter_rows(min_row=lo, max_row=hi, max_col=11, values_only=True):
+                if row[10] is not None and isinstance(row[10], (int, float)):
+                    last_bal  = row[10]
+                    last_date = row[0]
+            if last_bal is not None:
+                break
+        res = (last_bal, last_date) if last_bal else None
+        _memo_store(key, "balance", res)
+        return res
     except Exception as e:
         log.error(f"Excel balance: {e}"); return None
+    finally:
+        if own and wb is not None: wb.close()
+
+def _fx_map(wb) -> dict:
+    """{ccy: rate} from Settings!A7:B25, parsed once per open workbook.
+    Rates can't change under an open handle, so the map rides on the wb
+    object — loops over pending invoices stop rescanning Settings per row."""
+    m = getattr(wb, "_fx_map", None)
+    if m is None:
+        m = {}
+        try:
+            for row in wb["Settings"].iter_rows(min_row=7, max_row=25, values_only=True):
+                if row[0] and isinstance(row[1], (int, float)):
+                    m[str(row[0])] = float(row[1])
+        except Exception: pass
+        try: wb._fx_map = m
+        except Exception: pass
+    return m
+
 
 def _compute_usd(wb, ccy, amount):
     """Compute USD equivalent from FX Settings — no formula cache needed."""
     if not isinstance(amount, (int, float)) or amount <= 0:
         return None
-    fx = 1.0
-    try:
-        for row in wb["Settings"].iter_rows(min_row=7, max_row=25, values_only=True):
-            if row[0] and str(row[0]) == str(ccy) and isinstance(row[1], (int,float)):
-                fx = float(row[1]); break
-    except Exception: pass
+    fx = _fx_map(wb).get(str(ccy), 1.0)
     return round(amount / fx, 2) if fx else amount
 
 
-def get_pending_invoices():
+def get_pending_invoices(wb=None):
     """Returns (lines, usd_total, tbc_count) for all non-paid invoices.
     Computes USD from Settings FX table — works even after openpyxl save clears formula cache."""
-    if not EXCEL_FILE.exists(): return [], 0.0, 0
+    own = wb is None
+    key = _excel_key() if own else None
+    hit, cached = _memo_get(key, "pending")
+    if hit: return cached
     try:
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        if own: wb = _open_wb_readonly()
+        if wb is None: return [], 0.0, 0
         ws = wb["Invoices"]
         out = []
         usd_total = 0.0
@@ -316,16 +475,23 @@ def get_pending_invoices():
                     tbc_count += 1
                 benef_str = f" | for: {row[10]}" if row[10] else ""
                 out.append(f"- {row[2] or '?'}: {amt} {ccy}{usd_str}{benef_str}")
+        _memo_store(key, "pending", (out, usd_total, tbc_count))
         return out, usd_total, tbc_count
     except Exception as e:
         log.error(f"Excel pending: {e}"); return [], 0.0, 0
+    finally:
+        if own and wb is not None: wb.close()
 
 
 def get_recent_unconfirmed(days=14):
     """Get recent Cash In / Deposits that might not be confirmed by agent yet."""
     if not EXCEL_FILE.exists(): return []
+    key = _excel_key()
+    hit, cached = _memo_get(key, f"unconfirmed:{days}")
+    if hit: return cached
+    wb = None
     try:
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        wb = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
         ws = wb["Transactions"]
         items = []
         for row in ws.iter_rows(min_row=5, max_col=12, values_only=True):
@@ -335,33 +501,45 @@ def get_recent_unconfirmed(days=14):
                 if "unconfirmed" in note or "follow up" in note or "not confirm" in note:
                     amt = f"{row[5]:,.2f}" if isinstance(row[5],(int,float)) else str(row[5])
                     items.append(f"- {row[0]}: {row[2] or ''} | {amt} {row[4] or ''} | ПРИМЕЧАНИЕ: {row[11]}")
+        _memo_store(key, f"unconfirmed:{days}", items)
         return items
     except Exception as e:
         log.error(f"get_recent_unconfirmed error: {e}"); return []
+    finally:
+        if wb is not None: wb.close()
 
 
 def get_existing_invoices_list():
     """Return list of existing invoice IDs and payees for dedup check.
     Includes Excel row numbers so Claude can target edits correctly."""
     if not EXCEL_FILE.exists(): return ""
+    key = _excel_key()
+    hit, cached = _memo_get(key, "inv_list")
+    if hit: return cached
+    wb = None
     try:
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        wb = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
         wi = wb["Invoices"]
         lines = []
         for i, row in enumerate(wi.iter_rows(min_row=5, values_only=True), start=5):
             if row[1] or row[2]:
                 benef_str = f" | for={row[10]}" if len(row) > 10 and row[10] else ""
                 lines.append(f"row={i} | inv={row[1] or '?'} | payee={row[2] or '?'} | ccy={row[3]} | amt={row[4]} | status={row[6]}{benef_str}")
-        return "\n".join(lines)
+        res = "\n".join(lines)
+        _memo_store(key, "inv_list", res)
+        return res
     except Exception as e:
         log.error(f"get_existing_invoices: {e}"); return ""
+    finally:
+        if wb is not None: wb.close()
 
 def get_recent_transactions(days: int = 60) -> list:
     """Read recent transactions from Excel for dedup check."""
     if not EXCEL_FILE.exists():
         return []
+    wb = None
     try:
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        wb = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
         ws = wb["Transactions"]
         cutoff = date_type.today() - timedelta(days=days)
         result = []
@@ -378,6 +556,8 @@ def get_recent_transactions(days: int = 60) -> list:
     except Exception as e:
         log.error(f"get_recent_transactions: {e}")
         return []
+    finally:
+        if wb is not None: wb.close()
 
 
 def _is_duplicate_tx(tx_candidate: dict, existing_txs: list) -> tuple:
@@ -446,8 +626,9 @@ def _get_paid_invoice_nos() -> set:
     """Return set of invoice_no strings that are already ✅ Paid in Excel."""
     if not EXCEL_FILE.exists():
         return set()
+    wb = None
     try:
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        wb = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
         wi = wb["Invoices"]
         paid = set()
         for row in wi.iter_rows(min_row=5, max_col=10, values_only=True):
@@ -457,6 +638,8 @@ def _get_paid_invoice_nos() -> set:
     except Exception as e:
         log.error(f"_get_paid_invoice_nos: {e}")
         return set()
+    finally:
+        if wb is not None: wb.close()
 
 
 def _invoice_has_transaction(invoice_no: str) -> bool:
@@ -466,9 +649,9 @@ def _invoice_has_transaction(invoice_no: str) -> bool:
     """
     if not EXCEL_FILE.exists():
         return False
+    wb = None
     try:
-        import re
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        wb = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
         ws = wb["Transactions"]
         raw = invoice_no.strip()
 
@@ -504,6 +687,8 @@ def _invoice_has_transaction(invoice_no: str) -> bool:
     except Exception as e:
         log.error(f"_invoice_has_transaction: {e}")
         return False
+    finally:
+        if wb is not None: wb.close()
 
 
 def _dedup_invoice_updates(data: dict) -> tuple:
@@ -547,37 +732,98 @@ def _dedup_invoice_updates(data: dict) -> tuple:
     return data, skipped
 
 
-def get_unknown_transactions():
-    if not EXCEL_FILE.exists(): return []
+def snapshot_excel():
+    """Report snapshot from one workbook open: (balance, pending, unknown).
+    Transactions is walked once, collecting the last balance and the unknown
+    rows in the same pass; Invoices once for pending."""
+    wb = None
+    try:
+        wb = _open_wb_readonly()
+        if wb is None:
+            return None, ([], 0.0, 0), []
+        last_bal = last_date = None
+        unknown = []
+        for row in wb["Transactions"].iter_rows(min_row=5, max_col=12, values_only=True):
+            if row[10] is not None and isinstance(row[10], (int, float)):
+                last_bal, last_date = row[10], row[0]
+            if isinstance(row[1], str) and "Unknown" in row[1]:
+                amt = f"{row[5]:,.2f}" if isinstance(row[5], (int,float)) else str(row[5] or "?")
+                unknown.append(f"- {row[0]}: {row[2] or '?'} | {amt} {row[4] or ''}")
+        balance = (last_bal, last_date) if last_bal else None
+        return balance, get_pending_invoices(wb), unknown
+    except Exception as e:
+        log.error(f"Excel snapshot: {e}")
+        return None, ([], 0.0, 0), []
+    finally:
+        if wb is not None: wb.close()
+
+
+def get_unknown_transactions(wb=None):
+    own = wb is None
+    key = _excel_key() if own else None
+    hit, cached = _memo_get(key, "unknown")
+    if hit: return cached
     try:
-        wb = load_workbook(EXCEL_FILE, data_only=True)
+        if own: wb = _open_wb_readonly()
+        if wb is None: return []
         ws = wb["Transactions"]
         out = []
         for row in ws.iter_rows(min_row=5, max_col=12, values_only=True):
-            if row[1] and "Unknown" in str(row[1]):
+            # Text cells come back as str in values_only mode — test in place,
+            # no str() coercion per cell
+            if isinstance(row[1], str) and "Unknown" in row[1]:
                 amt = f"{row[5]:,.2f}" if isinstance(row[5], (int,float)) else str(row[5] or "?")
                 out.append(f"- {row[0]}: {row[2] or '?'} | {amt} {row[4] or ''}")
+        _memo_store(key, "unknown", out)
         return out
     except Exception as e:
         log.error(f"Excel unknown: {e}"); return []
+    finally:
+        if own and wb is not None: wb.close()
 
 # ── Excel write ───────────────────────────────────────────────────────────────
 def find_last_row(ws, start=5):
-    """Find last data row by checking col A (date) OR col B (type/invoice_no)."""
-    last = start - 1
-    for row in ws.iter_rows(min_row=start, max_col=2):
-        if row[0].value is not None or row[1].value is not None:
-            last = row[0].row
-    return last
+    """Find last data row by checking col A (date) OR col B (type/invoice_no).
+    Walks backward from ws.max_row so the common case costs a couple of cell
+    reads instead of a full forward scan. (max_row alone isn't trusted — it
+    overshoots when styled-but-empty rows trail the data.)"""
+    for r in range(ws.max_row, start - 1, -1):
+        if ws.cell(r, 1).value is not None or ws.cell(r, 2).value is not None:
+            return r
+    return start - 1
+
+# Tail-row markers persisted in Settings so consecutive /update runs don't
+# re-discover the last row. Validated against the sheet before use — manual
+# edits, uploads and row deletions make them stale.
+_ROW_MARKERS = {"Transactions": "Z1", "Invoices": "Z2"}
+
+def _last_row_from_marker(wb, ws):
+    """Return the last data row from the persisted marker, or find_last_row
+    when the marker is missing or no longer matches the sheet."""
+    cell = _ROW_MARKERS.get(ws.title)
+    try:
+        v = wb["Settings"][cell].value if cell else None
+    except Exception:
+        v = None
+    if isinstance(v, (int, float)) and v >= 4:
+        r = int(v)
+        row_has_data  = r == 4 or ws.cell(r, 1).value is not None or ws.cell(r, 2).value is not None
+        next_is_empty = ws.cell(r + 1, 1).value is None and ws.cell(r + 1, 2).value is None
+        if row_has_data and next_is_empty:
+            return r
+    return find_last_row(ws)
+
+def _store_row_marker(wb, ws, last_row: int):
+    cell = _ROW_MARKERS.get(ws.title)
+    if not cell: return
+    try:
+        wb["Settings"][cell] = last_row
+    except Exception as e:
+        log.error(f"_store_row_marker: {e}")
 
 def _get_fx(ws_parent, ccy):
     """Lookup FX rate from Settings sheet."""
-    try:
-        for row in ws_parent["Settings"].iter_rows(min_row=7, max_row=25, values_only=True):
-            if str(row[0]) == ccy and row[1]:
-                return float(row[1])
-    except Exception: pass
-    return 1.0
+    return _fx_map(ws_parent).get(ccy) or 1.0
 
 def _get_comm(tp, ccy):
     """Get commission rate."""
@@ -586,12 +832,14 @@ def _get_comm(tp, ccy):
             "Cash Out":0.005,"❓ Unknown":0.005}.get(tp, 0.005)
 
 def _prev_balance(ws, r):
-    """Get last computed balance before row r."""
-    last = 0.0
-    for row in ws.iter_rows(min_row=5, max_row=r-1, max_col=11, values_only=True):
-        if row[10] is not None and isinstance(row[10], (int,float)):
-            last = float(row[10])
-    return last
+    """Get last computed balance before row r. Walks backward so sequential
+    appends (where r-1 holds the balance just written) cost one cell read
+    instead of a scan from the top per inserted row."""
+    for rr in range(r - 1, 4, -1):
+        v = ws.cell(rr, 11).value
+        if isinstance(v, (int, float)):
+            return float(v)
+    return 0.0
 
 def apply_tx_row(ws, r, tx):
     # Normalize type — Claude sometimes returns variants
@@ -647,17 +895,28 @@ def apply_tx_row(ws, r, tx):
         sc(ws.cell(r, 14, benef), bg=bg, sz=9, wrap=False)
     ws.row_dimensions[r].height = 28
 
-def _parse_date(s):
-    """Parse DD.MM.YYYY or similar to date object, return None on fail."""
-    from datetime import date as ddate
-    if not s: return None
+@functools.lru_cache(maxsize=4096)
+def _parse_date_str(s: str):
+    # Fast path: agent dates are almost always DD.MM.YYYY — build the date
+    # directly instead of running the strptime state machine
+    if len(s) == 10 and s[2] == "." and s[5] == ".":
+        try:
+            return date_type(int(s[6:10]), int(s[3:5]), int(s[0:2]))
+        except ValueError:
+            pass
     for fmt in ("%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y"):
         try:
-            from datetime import datetime
-            return datetime.strptime(str(s).strip(), fmt).date()
-        except: pass
+            return datetime.strptime(s, fmt).date()
+        except ValueError:
+            pass
     return None
 
+def _parse_date(s):
+    """Parse DD.MM.YYYY or similar to date object, return None on fail.
+    The duplicate scans re-parse the same few dates many times — cached."""
+    if not s: return None
+    return _parse_date_str(str(s).strip())
+
 
 def _find_duplicate_tx(wst, payee: str, ccy: str, amount: float, date_str: str,
                        ref: str = None) -> int | None:
@@ -668,11 +927,12 @@ def _find_duplicate_tx(wst, payee: str, ccy: str, amount: float, date_str: str,
     EXCLUSION: if ref provided and candidate has a DIFFERENT non-empty ref → not a duplicate
     (two real payments to same payee for same amount with different refs = different invoices).
     """
-    from datetime import timedelta
     ref_date = _parse_date(date_str)
     payee_lo = (payee or "").lower().strip()
     ref_lo   = (ref or "").lower().strip()
 
+    payee_words = [w for w in payee_lo.split() if len(w) > 3]
+
     for row_idx, row in enumerate(wst.iter_rows(min_row=5, max_col=12, values_only=True), start=5):
         if not row[0]: continue
         r_type = str(row[1] or "")
@@ -681,7 +941,6 @@ def _find_duplicate_tx(wst, payee: str, ccy: str, amount: float, date_str: str,
         # Payee match (partial)
         r_payee = str(row[3] or "").lower()
         r_desc  = str(row[2] or "").lower()
-        payee_words = [w for w in payee_lo.split() if len(w) > 3]
         payee_match = any(w in r_payee or w in r_desc for w in payee_words) if payee_words else False
 
         # CCY + amount match (within 1%)
@@ -725,9 +984,25 @@ def _flag_duplicate(wst, row_a: int, row_b: int):
         c.font = Font(name="Arial", size=8, color="FF843C0C", bold=True)
 
 
-def apply_inv_update(ws, upd, wst=None):
+def build_invoice_index(ws) -> dict:
+    """One pass over the Invoices sheet → {normalized key: row_number}, keyed
+    by both invoice_no (col B) and ref (col I). Lets apply_inv_update resolve
+    exact matches as a dict lookup and substring matches against the
+    already-normalized keys instead of rescanning cells per update."""
+    index = {}
+    for row in ws.iter_rows(min_row=5, max_col=9):
+        no  = str(row[1].value or "").strip().lower()
+        ref = str(row[8].value or "").strip().lower()
+        if no:  index.setdefault(no,  row[0].row)
+        if ref: index.setdefault(ref, row[0].row)
+    return index
+
+
+def apply_inv_update(ws, upd, wst=None, inv_index=None):
     """
     Mark invoice as paid AND auto-create a Payment transaction if not already exists.
+    inv_index (from build_invoice_index) short-circuits the row scan on exact
+    invoice_no matches; fuzzy/ref/payee matching still falls back to the scan.
     Returns (found: bool, tx_created: bool, duplicate_row: int|None)
     """
     inv_no  = str(upd.get("invoice_no","")).strip().lower()
@@ -739,7 +1014,18 @@ def apply_inv_update(ws, upd, wst=None):
         status = raw_status
     bg      = STAT_BG.get(status, YELLOW)
 
-    for row in ws.iter_rows(min_row=5, max_col=11):
+    if not inv_no:
+        rows_iter = ()  # nothing to match — go straight to the payee fallback
+    elif inv_index is not None:
+        # Exact key first, then substring over the pre-normalized keys —
+        # keys iterate in row order, so first-match semantics are preserved
+        hit = inv_index.get(inv_no) or next(
+            (r for k, r in inv_index.items() if inv_no in k or k in inv_no), None)
+        rows_iter = ws.iter_rows(min_row=hit, max_row=hit, max_col=11) if hit else ()
+    else:
+        rows_iter = ws.iter_rows(min_row=5, max_col=11)
+
+    for row in rows_iter:
         if not inv_no:
             continue
         cell_inv = str(row[1].value or "").strip().lower()
@@ -935,28 +1221,21 @@ def add_new_invoice(ws, inv, last_row):
 
 def _recalc_balance_chain(ws, from_row: int):
     """Recompute K (Balance) for all rows from from_row downward."""
-    from openpyxl.styles import Font, PatternFill, Alignment
-    YELLOW = PatternFill("solid", fgColor="FFFFF2CC")
-    prev_bal = 0.0
-    for pr in ws.iter_rows(min_row=5, max_row=from_row-1, max_col=11, values_only=True):
-        if pr[10] is not None and isinstance(pr[10], (int, float)):
-            prev_bal = float(pr[10])
+    prev_bal = _prev_balance(ws, from_row)
     if prev_bal == 0.0:
         try:
             s = ws.parent["Settings"].cell(4, 3).value
             if s and isinstance(s, (int, float)): prev_bal = float(s)
         except: pass
+    # iter_rows hands us the cells — no ws.cell() re-lookup per column
     for r_cells in ws.iter_rows(min_row=from_row, max_col=11):
-        r = r_cells[0].row
-        if not ws.cell(r, 1).value: break
-        net_val = ws.cell(r, 10).value
-        try: net = float(net_val) if isinstance(net_val, (int, float)) else 0.0
-        except: net = 0.0
+        if not r_cells[0].value: break
+        net_val = r_cells[9].value
+        net = float(net_val) if isinstance(net_val, (int, float)) else 0.0
         new_bal = round(prev_bal + net, 2)
-        c = ws.cell(r, 11, new_bal)
-        c.number_format = "#,##0.00"; c.fill = YELLOW
-        c.font = Font(name="Arial", size=9, bold=True, color="1F3864")
-        c.alignment = Alignment(horizontal="right", vertical="center")
+        c = r_cells[10]
+        c.value = new_bal
+        sc(c, bg=YELLOW, bold=True, fc="1F3864", num='#,##0.00')
         prev_bal = new_bal
 
 
@@ -971,14 +1250,16 @@ def apply_transaction_update(ws, upd):
     if not match_desc:
         return False
 
-    for row in ws.iter_rows(min_row=5):
+    keywords = [w for w in match_desc.split() if len(w) > 3]
+
+    for row in ws.iter_rows(min_row=5, max_col=12):
         r = row[0].row
-        desc  = str(ws.cell(r,3).value or "").lower()
-        date  = str(ws.cell(r,1).value or "")
-        notes = str(ws.cell(r,12).value or "")
+        desc     = str(row[2].value or "").lower()
+        date     = str(row[0].value or "")
+        notes    = str(row[11].value or "")
+        notes_lo = notes.lower()
 
-        keywords = [w for w in match_desc.split() if len(w) > 3]
-        matches  = sum(1 for kw in keywords if kw in desc or kw in notes.lower())
+        matches = sum(1 for kw in keywords if kw in desc or kw in notes_lo)
 
         if matches >= 1:
             if match_date and match_date not in date:
@@ -987,8 +1268,6 @@ def apply_transaction_update(ws, upd):
             # FX rate correction with full recalculation
             if new_fx:
                 try:
-                    from openpyxl.styles import Font, PatternFill, Alignment
-                    YELLOW = PatternFill("solid", fgColor="FFFFF2CC")
                     fx    = float(new_fx)
                     amt   = float(ws.cell(r, 6).value or 0)
                     tp    = str(ws.cell(r, 2).value or "")
@@ -996,20 +1275,9 @@ def apply_transaction_update(ws, upd):
                     gross = round(amt / fx, 2) if fx else amt
                     net   = round(gross, 2) if tp in ("Deposit","Cash In") else round(-(gross/max(1-comm,0.0001)),2)
 
-                    c = ws.cell(r, 7, round(fx, 5))
-                    c.number_format="0.00000"; c.fill=YELLOW
-                    c.font=Font(name="Arial",size=9,color="0000CC")
-                    c.alignment=Alignment(horizontal="right",vertical="center")
-
-                    c = ws.cell(r, 8, gross)
-                    c.number_format="#,##0.00"; c.fill=YELLOW
-                    c.font=Font(name="Arial",size=9)
-                    c.alignment=Alignment(horizontal="right",vertical="center")
-
-                    c = ws.cell(r, 10, round(net, 2))
-                    c.number_format="#,##0.00"; c.fill=YELLOW
-                    c.font=Font(name="Arial",size=9)
-                    c.alignment=Alignment(horizontal="right",vertical="center")
+                    sc(ws.cell(r, 7, round(fx, 5)), bg=YELLOW, fc="0000CC", num="0.00000")
+                    sc(ws.cell(r, 8, gross), bg=YELLOW, num="#,##0.00")
+                    sc(ws.cell(r, 10, round(net, 2)), bg=YELLOW, num="#,##0.00")
 
                     _recalc_balance_chain(ws, r)
                     notes = notes.replace("⏳ ПРЕДВ. КУРС","").replace("⏳ PRELIMINARY RATE","").strip(" |")
@@ -1041,38 +1309,68 @@ def apply_transaction_update(ws, upd):
     log.warning(f"Transaction not found for update: {match_desc}")
     return False
 
-def _check_all_duplicates(wst) -> list:
+def _check_all_duplicates(wst, min_new_row=5) -> list:
     """
     Scan all Transactions for possible duplicates.
     Returns list of (row_a, row_b, reason) tuples for flagging.
+    min_new_row limits output to pairs whose later row is at or below it —
+    write_to_excel passes the first freshly written row so pairs between
+    untouched older rows aren't re-flagged on every update.
+
+    Rows are grouped by currency and sorted by amount, so each row is only
+    compared against the few neighbours inside the 1% amount window instead
+    of every other row — the old all-pairs loop was O(N²) with a date parse
+    per pair. Dates and payee tokens are parsed once per row.
     """
-    from datetime import timedelta
-    rows = []
+    by_ccy = {}
     for row_idx, row in enumerate(wst.iter_rows(min_row=5, max_col=12, values_only=True), start=5):
         if not row[0]: continue
-        rows.append((row_idx, row))
+        if row[1] not in ("Payment", "Deposit"): continue
+        try: amt = float(row[5] or 0)
+        except: continue
+        pl = str(row[3] or row[2] or "").lower()
+        by_ccy.setdefault(row[4], []).append(
+            (row_idx, row, amt, _parse_date(row[0]), pl,
+             [w for w in pl.split() if len(w) > 3]))
 
     flags = []
-    for i, (ra, a) in enumerate(rows):
-        for rb, b in rows[i+1:]:
-            if a[1] not in ("Payment","Deposit") or b[1] not in ("Payment","Deposit"): continue
-            try:
-                amt_a = float(a[5] or 0); amt_b = float(b[5] or 0)
-            except: continue
-            if a[4] != b[4] or amt_a == 0: continue
-            if abs(amt_a - amt_b) / max(amt_a, 1) > 0.01: continue
-            da = _parse_date(a[0]); db = _parse_date(b[0])
-            if da and db and abs((da - db).days) > 10: continue
-            pa = str(a[3] or a[2] or "").lower()
-            pb = str(b[3] or b[2] or "").lower()
-            words = [w for w in pa.split() if len(w) > 3]
-            if not any(w in pb for w in words): continue
-            flags.append((ra, rb, f"{a[4]} {amt_a:,.0f} | {a[3]} | {a[0]} vs {b[0]}"))
+    for group in by_ccy.values():
+        group.sort(key=lambda t: t[2])
+        for i in range(len(group)):
+            amt_i = group[i][2]
+            for j in range(i + 1, len(group)):
+                # amounts ascend — past the 1% window nothing further matches
+                if group[j][2] - amt_i > 0.01 * max(group[j][2], 1):
+                    break
+                # same checks as the old pairwise loop, in sheet-row order
+                (ra, a, amt_a, da, pa, wa), (rb, b, amt_b, db, pb, wb_) = sorted(
+                    (group[i], group[j]))
+                if rb < min_new_row: continue
+                if amt_a == 0: continue
+                if abs(amt_a - amt_b) / max(amt_a, 1) > 0.01: continue
+                if da and db and abs((da - db).days) > 10: continue
+                if not any(w in pb for w in wa): continue
+                flags.append((ra, rb, f"{a[4]} {amt_a:,.0f} | {a[3]} | {a[0]} vs {b[0]}"))
+    flags.sort()
     return flags
 
 
+# Workbook writes run on worker threads; two concurrent load/modify/save
+# cycles would silently drop one side's changes, so they queue on one lock
+_excel_lock = asyncio.Lock()
+
+async def _locked_write(fn, *args):
+    async with _excel_lock:
+        return await asyncio.to_thread(fn, *args)
+
+
 def write_to_excel(data: dict):
     if not EXCEL_FILE.exists(): return 0,0,0,0,0,[]
+    # Summary-only Claude replies carry no rows — don't pay the workbook
+    # parse + save just to loop over empty lists
+    if not any((data.get("new_transactions"), data.get("invoice_updates"),
+                data.get("new_invoices"), data.get("transaction_updates"))):
+        return 0,0,0,0,0,[]
     wb  = load_workbook(EXCEL_FILE)
     wst = wb["Transactions"]; wsi = wb["Invoices"]
     tx_a = inv_u = inv_a = 0
@@ -1103,34 +1401,71 @@ def write_to_excel(data: dict):
         else:
             log.info(f"Dropped duplicate new_transaction (covered by invoice_update): {tx.get('description','')}")
 
+    # Find the insertion point once per sheet and count upward — one scan
+    # instead of one per inserted row
+    next_tx_row = _last_row_from_marker(wb, wst) + 1
+    tx_seed = next_tx_row
     for tx in filtered_txns:
-        apply_tx_row(wst, find_last_row(wst) + 1, tx); tx_a += 1
+        apply_tx_row(wst, next_tx_row, tx); tx_a += 1; next_tx_row += 1
+    inv_index = build_invoice_index(wsi) if data.get("invoice_updates") else {}
     for upd in data.get("invoice_updates", []):
-        found, tx_created, dup_row = apply_inv_update(wsi, upd, wst)
+        found, tx_created, dup_row = apply_inv_update(wsi, upd, wst, inv_index=inv_index)
         if found:
             inv_u += 1
             if tx_created: auto_tx += 1
             if dup_row: dup_warnings.append(
                 f"⚠ Транзакция для {upd.get('invoice_no','')} уже существует (строка {dup_row}) — не дублировал")
+    next_inv_row = _last_row_from_marker(wb, wsi) + 1
     for inv in data.get("new_invoices", []):
-        add_new_invoice(wsi, inv, find_last_row(wsi)); inv_a += 1
+        add_new_invoice(wsi, inv, next_inv_row - 1); inv_a += 1; next_inv_row += 1
+
+    # Auto-created transactions are appended right after the explicit ones,
+    # so the final tail rows follow from the counters — no rescan needed
+    last_tx_row  = next_tx_row - 1 + auto_tx
+    last_inv_row = next_inv_row - 1
 
-    # Run duplicate scan across all transactions
-    dup_pairs = _check_all_duplicates(wst)
-    for ra, rb, reason in dup_pairs:
-        _flag_duplicate(wst, ra, rb)
-        dup_warnings.append(f"⚠ ДУБЛЬ: строки {ra} и {rb} — {reason}")
+    # Duplicate scan over the delta: only pairs that involve a row written
+    # in this call — pairs between older rows were flagged when written
+    if last_tx_row >= tx_seed:
+        dup_pairs = _check_all_duplicates(wst, min_new_row=tx_seed)
+        for ra, rb, reason in dup_pairs:
+            _flag_duplicate(wst, ra, rb)
+            dup_warnings.append(f"⚠ ДУБЛЬ: строки {ra} и {rb} — {reason}")
 
     # Recalc full balance chain after any tx additions to fix any gaps
     if tx_a > 0 or auto_tx > 0:
-        first_new = find_last_row(wst) - (tx_a + auto_tx)
+        first_new = last_tx_row - (tx_a + auto_tx)
         if first_new >= 5:
             _recalc_balance_chain(wst, first_new)
 
-    wb.save(EXCEL_FILE)
+    _store_row_marker(wb, wst, last_tx_row)
+    _store_row_marker(wb, wsi, last_inv_row)
+    _save_wb(wb)
     return tx_a, inv_u, inv_a, tx_upd, auto_tx, dup_warnings
 
 # ── Claude API ────────────────────────────────────────────────────────────────
+# One shared AsyncClient for all Claude calls — keep-alive + HTTP/2 skips the
+# TCP/TLS handshake (100-300 ms) that per-call clients paid on every request.
+_claude_client = None
+
+# Bound in-flight Claude requests so we stay under the tier rate limit
+_claude_sem = asyncio.Semaphore(3)
+
+def _get_claude_client() -> httpx.AsyncClient:
+    global _claude_client
+    if _claude_client is None:
+        _claude_client = httpx.AsyncClient(
+            base_url="https://api.anthropic.com",
+            http2=True,
+            timeout=httpx.Timeout(120.0, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+            headers={"x-api-key": ANTHROPIC_KEY,
+                     "anthropic-version": "2023-06-01",
+                     "content-type": "application/json"},
+        )
+    return _claude_client
+
+
 async def ask_claude(prompt_or_content, system=None) -> str:
     """
     Send a request to Claude API.
@@ -1148,58 +1483,44 @@ async def ask_claude(prompt_or_content, system=None) -> str:
         content = prompt_or_content  # already a list of content blocks
 
     # Add caching header only when system is a cacheable list
-    headers = {
-        "x-api-key": ANTHROPIC_KEY,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json",
-    }
+    headers = {}
     if isinstance(sys_payload, list):
         headers["anthropic-beta"] = "prompt-caching-2024-07-31"
 
-    async with httpx.AsyncClient(timeout=120) as client:
-        r = await client.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json={"model": "claude-opus-4-6", "max_tokens": 4000,
-                  "temperature": 0,
-                  "system": sys_payload,
-                  "messages": [{"role": "user", "content": content}]},
-        )
-        data = r.json()
-        if "error" in data:
-            raise RuntimeError(f"Claude API error: {data['error']}")
-        return data["content"][0]["text"]
-
-def _build_parse_system_prompt() -> list:
-    """
-    Build the full system prompt for parse_messages / invoice parsing.
-    Returns a cacheable list block for Claude API prompt caching.
-    """
-    context = load_context()
-    excel_bal = get_balance_from_excel()
-    bal_str = f"${excel_bal[0]:,.2f} (запись: {excel_bal[1]})" if excel_bal else "нет данных"
-    unconfirmed = get_recent_unconfirmed()
-    unconfirmed_str = "\n".join(unconfirmed) if unconfirmed else "нет"
-    existing_inv = get_existing_invoices_list()
-
-    text = f"""КОНТЕКСТ ПРОЕКТА (обязательно учитывай):
-{context}
-
-ТЕКУЩИЙ БАЛАНС В EXCEL: {bal_str}
-
-НЕПОДТВЕРЖДЁННЫЕ ТРАНЗАКЦИИ (мы отправили, агент ещё не подтвердил):
-{unconfirmed_str}
-
-УЖЕ СУЩЕСТВУЮЩИЕ ИНВОЙСЫ В EXCEL (НЕ добавляй их снова!):
-{existing_inv}
+    client = _get_claude_client()
+    async with _claude_sem:
+        # Retry 429/5xx with exponential backoff, honoring Retry-After —
+        # a rate-limited response has no "content" and used to crash the handler.
+        for attempt in range(5):
+            r = await client.post(
+                "/v1/messages",
+                headers=headers,
+                json={"model": "claude-opus-4-6", "max_tokens": 4000,
+                      "temperature": 0,
+                      "system": sys_payload,
+                      "messages": [{"role": "user", "content": content}]},
+            )
+            if (r.status_code == 429 or r.status_code >= 500) and attempt < 4:
+                try:
+                    delay = float(r.headers.get("retry-after", ""))
+                except ValueError:
+                    delay = min(60, 2 ** attempt + random.random())
+                log.warning(f"Claude API {r.status_code}, retry in {delay:.1f}s "
+                            f"(attempt {attempt + 1}/5)")
+                await asyncio.sleep(delay)
+                continue
+            break
+    data = _json_loads(r.content)  # bytes in, no intermediate str decode
+    if "error" in data:
+        raise RuntimeError(f"Claude API error: {data['error']}")
+    return data["content"][0]["text"]
 
----
-Из новых сообщений от финансового агента извлеки структурированные данные.
+_PARSE_RULES = """Из новых сообщений от финансового агента извлеки структурированные данные.
 
 Верни ТОЛЬКО валидный JSON без markdown:
-{{
+{
   "new_transactions": [
-    {{
+    {
       "date": "DD.MM.YYYY",
       "type": "Payment|Deposit|Cash Out|Cash In|❓ Unknown",
       "description": "краткое описание",
@@ -1211,10 +1532,10 @@ def _build_parse_system_prompt() -> list:
       "notes": "доп. инфо",
       "payer": null,
       "beneficiary": null
-    }}
+    }
   ],
   "invoice_updates": [
-    {{
+    {
       "invoice_no": "номер инвойса",
       "new_status": "✅ Paid|⏳ Pending|⚠ Partial/Check|❓ Clarify",
       "date_paid": "DD.MM.YYYY",
@@ -1224,10 +1545,10 @@ def _build_parse_system_prompt() -> list:
       "swift_date": null,
       "swift_fx": null,
       "beneficiary": null
-    }}
+    }
   ],
   "new_invoices": [
-    {{
+    {
       "date": "DD.MM.YYYY",
       "invoice_no": "номер",
       "payee": "получатель",
@@ -1236,27 +1557,27 @@ def _build_parse_system_prompt() -> list:
       "status": "⏳ Pending",
       "notes": "",
       "beneficiary": null
-    }}
+    }
   ],
   "transaction_updates": [
-    {{
+    {
       "match_description": "ключевые слова из описания существующей транзакции",
       "match_date": "DD.MM.YYYY или пусто",
       "new_notes": "",
       "confirmed": true,
       "fx_rate": null
-    }}
+    }
   ],
-  "balance_reconciliation": {{
+  "balance_reconciliation": {
     "agent_stated_balance": null,
     "our_excel_balance": null,
     "difference": null,
     "difference_explained_by": [],
     "unexplained_difference": null
-  }},
+  },
   "context_update": "краткая запись для контекста — что нового узнали из этих сообщений",
   "summary": "2-3 предложения — что нового произошло"
-}}
+}
 
 Правила:
 - Сообщение с балансом агента ("Остаток: X") — занеси в balance_reconciliation, не в транзакции
@@ -1351,14 +1672,120 @@ BENEFICIARY (для кого, Transactions col N / Invoices col K):
    Если unexplained_difference близко к 0 — всё сходится.
    Если большое — есть реальное расхождение которое надо уточнять у агента."""
 
-    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+# Static /edit instruction block — built once so cmd_edit interpolates only
+# the sheet state and user command, and the prefix stays byte-stable for the
+# prompt cache
+_EDIT_RULES = """You are a JSON assistant. Return ONLY valid JSON, no markdown, no backticks.
+
+Верни ТОЛЬКО валидный JSON без markdown:
+{
+  "sheet": "Transactions|Invoices",
+  "action": "update|delete",
+  "row_number": 42,
+  "changes": {
+    "col_A": null,
+    "col_B": null,
+    "col_C": null,
+    "col_D": null,
+    "col_E": null,
+    "col_F": null,
+    "col_G": null,
+    "col_H": null,
+    "col_I": null,
+    "col_J": null,
+    "col_K": null,
+    "col_L": null
+  },
+  "description": "одна строка — что именно меняем и почему"
+}
+
+Правила:
+- row_number: точный номер строки Excel (начиная с 5)
+- changes: только те колонки которые нужно изменить, остальные null
+- action=delete: удалить строку целиком
+- Если команда непонятна или строка не найдена — верни {"error": "описание проблемы"}
+- Не пересчитывай баланс — только меняй указанные поля
+
+КОЛОНКИ Transactions: col_A=Date, col_B=Type, col_C=Description, col_D=Payee, col_E=CCY, col_F=Amount(число), col_G=FX, col_H=GrossUSD, col_I=Comm%, col_J=NetUSD, col_K=Balance, col_L=Notes, col_M=Payer, col_N=Beneficiary
+КОЛОНКИ Invoices: col_A=Date, col_B=InvNo, col_C=Payee, col_D=CCY(валюта), col_E=Amount(ЧИСЛО!), col_F=USD_equiv, col_G=Status, col_H=DatePaid, col_I=Ref, col_J=Notes, col_K=Beneficiary
+
+ВАЖНО для Invoices:
+- col_D = валюта (AED/USD/EUR/etc) — СТРОКА
+- col_E = сумма — ЧИСЛО (например 242022.05, не "AED"!)
+- Никогда не пиши валюту в col_E — только число
+- Payer/Beneficiary: наши юрлица (RAWRIMA FZCO, BALKEMY GENERAL TRADING, TROVECO DMCC, ELITESPHERE PTE LTD, NEXUS MARINE PTE LTD, GORNIK TRADING LTD и др.)"""
+
+_CHAT_RULES = """Ты финансовый ассистент для трекера платежей через агента.
+Отвечай по-русски, кратко и по делу.
+
+Если пользователь просит ДЕЙСТВИЕ — ответь JSON:
+{
+  "type": "action",
+  "action": "add_transaction|add_invoice|edit_transaction|edit_invoice|delete_transaction|delete_invoice|mark_invoice_paid",
+  "params": {...},
+  "preview": "одна строка — что именно сделаем",
+  "message": "текст ответа пользователю"
+}
+
+Если просто ВОПРОС — ответь JSON:
+{
+  "type": "text",
+  "message": "твой ответ"
+}
+
+ПАРАМЕТРЫ ПО ДЕЙСТВИЯМ:
+
+add_transaction: date, type(Payment|Deposit|Cash Out|Cash In|❓ Unknown), description, payee, ccy, amount, fx_rate(null=из настроек), comm(null), notes, payer(опц.), beneficiary(опц.)
+add_invoice: date, invoice_no, payee, ccy, amount, status(⏳ Pending), notes, beneficiary(опц.)
+edit_transaction: row_number(из списка в состоянии!), changes: {col_X: value}
+  Колонки: col_A=Date, col_B=Type, col_C=Desc, col_D=Payee, col_E=CCY, col_F=Amt, col_G=FX, col_L=Notes, col_M=Payer, col_N=Beneficiary
+edit_invoice: row_number(из списка инвойсов!), changes: {col_X: value}
+  Колонки: col_A=Date, col_B=InvNo, col_C=Payee, col_D=CCY, col_E=Amt, col_G=Status, col_H=DatePaid, col_I=Ref, col_J=Notes, col_K=Beneficiary
+delete_transaction: row_number
+delete_invoice: row_number
+mark_invoice_paid: invoice_no, new_status("✅ Paid"), date_paid, ref(опц.), swift_amount(опц.), swift_ccy(опц.) — ИСПОЛЬЗУЙ для отметки инвойса оплаченным, создаёт транзакцию автоматически
+
+ВАЖНО: row_number ВСЕГДА берётся из списков в состоянии, никогда не угадывай!"""
+
+
+def _build_parse_system_prompt() -> list:
+    """
+    Build the system prompt for parse_messages / invoice parsing.
+    Static rules go first as a byte-stable cached block; the volatile Excel
+    state follows in a separate uncached block, so the prefix cache survives
+    balance and context changes between calls.
+    """
+    context = load_context()
+    excel_bal = get_balance_from_excel()
+    bal_str = f"${excel_bal[0]:,.2f} (запись: {excel_bal[1]})" if excel_bal else "нет данных"
+    unconfirmed = get_recent_unconfirmed()
+    unconfirmed_str = "\n".join(unconfirmed) if unconfirmed else "нет"
+    existing_inv = get_existing_invoices_list()
+
+    state = f"""КОНТЕКСТ ПРОЕКТА (обязательно учитывай):
+{context}
+
+ТЕКУЩИЙ БАЛАНС В EXCEL: {bal_str}
+
+НЕПОДТВЕРЖДЁННЫЕ ТРАНЗАКЦИИ (мы отправили, агент ещё не подтвердил):
+{unconfirmed_str}
+
+УЖЕ СУЩЕСТВУЮЩИЕ ИНВОЙСЫ В EXCEL (НЕ добавляй их снова!):
+{existing_inv}"""
+
+    return [
+        {"type": "text", "text": _PARSE_RULES, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": state},
+    ]
 
 
 async def parse_messages(msgs_text: str) -> dict:
-    system = _build_parse_system_prompt()
+    # prompt state reads the workbook (cold memo after any write) — thread it
+    system = await asyncio.to_thread(_build_parse_system_prompt)
     prompt = f"Новые сообщения для анализа:\n{msgs_text}"
     raw = await ask_claude(prompt, system=system)
-    return json.loads(_clean_json(raw))
+    return _json_loads(_clean_json(raw))
 
 
 # ── Format confirmation message ───────────────────────────────────────────────
@@ -1556,7 +1983,7 @@ async def apply_pending_edit(pending_data: dict, instruction: str) -> dict:
     """
     # Serialize pending without internal flags for Claude
     clean = {k: v for k, v in pending_data.items() if not k.startswith("_")}
-    pending_str = json.dumps(clean, ensure_ascii=False, indent=2)
+    pending_str = _json_dumps(clean, indent=True)
 
     prompt = f"""У тебя есть JSON с данными которые готовятся к записи в Excel.
 Пользователь хочет внести правку перед записью.
@@ -1575,7 +2002,7 @@ async def apply_pending_edit(pending_data: dict, instruction: str) -> dict:
         "You are a JSON patch assistant. "
         "Return ONLY the complete patched JSON, no markdown, no explanation."
     ))
-    return json.loads(_clean_json(raw))
+    return _json_loads(_clean_json(raw))
 
 
 async def cmd_update(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -1604,9 +2031,9 @@ async def cmd_update(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         if has_media:
             content = _build_multimodal_content(msgs)
-            system  = _build_parse_system_prompt()
+            system  = await asyncio.to_thread(_build_parse_system_prompt)
             raw     = await ask_claude(content, system=system)
-            data    = json.loads(_clean_json(raw))
+            data    = _json_loads(_clean_json(raw))
         else:
             data = await parse_messages(_fmt(msgs))
     except Exception as e:
@@ -1627,8 +2054,8 @@ async def cmd_update(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     # Dedup: remove transactions and invoice updates already in Excel
-    data, skipped_txs = _dedup_transactions(data)
-    data, skipped_inv = _dedup_invoice_updates(data)
+    data, skipped_txs = await asyncio.to_thread(_dedup_transactions, data)
+    data, skipped_inv = await asyncio.to_thread(_dedup_invoice_updates, data)
     if skipped_txs:
         data["_skipped_txs"] = skipped_txs
     if skipped_inv:
@@ -1690,8 +2117,6 @@ async def cmd_update(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 def apply_edit(data: dict) -> str:
     """Apply an edit command to Excel."""
-    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-
     sheet_name = data.get("sheet", "Transactions")
     action     = data.get("action", "update")
     row_n      = int(data.get("row_number", 0))
@@ -1715,7 +2140,7 @@ def apply_edit(data: dict) -> str:
         # For Transactions: recompute balance chain from deleted row onward
         if sheet_name == "Transactions":
             _recalc_balance_chain(ws, row_n)
-        wb.save(EXCEL_FILE)
+        _save_wb(wb)
         return f"Строка {row_n} удалена.\n{desc}"
 
     # Map col names to indices
@@ -1753,12 +2178,7 @@ def apply_edit(data: dict) -> str:
                     fx = float(changes["col_G"])
                 except: pass
             if fx is None:
-                fx = 1.0
-                try:
-                    for srow in wb["Settings"].iter_rows(min_row=7, max_row=25, values_only=True):
-                        if srow[0] == ccy:
-                            fx = float(srow[1]); break
-                except: pass
+                fx = _fx_map(wb).get(ccy, 1.0)
 
             # Comm
             comm_map = {"Deposit":0.0,"Cash In":0.0,"Payment":0.005,"Cash Out":0.005,"❓ Unknown":0.005}
@@ -1772,11 +2192,8 @@ def apply_edit(data: dict) -> str:
             gross = round(amt / fx, 2) if fx else amt
             net   = round(gross, 2) if tp in ("Deposit","Cash In") else round(-(gross/max(1-comm,0.0001)),2)
 
-            # Previous balance
-            prev_bal = 0.0
-            for pr in ws.iter_rows(min_row=5, max_row=row_n-1, max_col=11, values_only=True):
-                if pr[10] is not None and isinstance(pr[10], (int, float)):
-                    prev_bal = float(pr[10])
+            # Previous balance — backward walk stops at the first numeric K
+            prev_bal = _prev_balance(ws, row_n)
             if prev_bal == 0.0:
                 try:
                     s = wb["Settings"].cell(4, 3).value
@@ -1834,7 +2251,7 @@ def apply_edit(data: dict) -> str:
                 ws.cell(row_n, 6).number_format = '#,##0.00'
                 applied.append(f"F(USD)={usd}")
 
-    wb.save(EXCEL_FILE)
+    _save_wb(wb)
     return f"Применено к строке {row_n}:\n" + "\n".join(f"  {a}" for a in applied) + f"\n\n{desc}"
 
 async def callback_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -1880,11 +2297,11 @@ async def callback_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         try:
             if action == "add_transaction":
                 tx_data = {"new_transactions":[params],"invoice_updates":[],"new_invoices":[]}
-                write_to_excel(tx_data)
+                await _locked_write(write_to_excel, tx_data)
                 msg2 = f"Транзакция добавлена."
             elif action == "add_invoice":
                 tx_data = {"new_transactions":[],"invoice_updates":[],"new_invoices":[params]}
-                write_to_excel(tx_data)
+                await _locked_write(write_to_excel, tx_data)
                 msg2 = f"Инвойс добавлен."
             elif action in ("edit_transaction","edit_invoice"):
                 sheet = "Transactions" if action == "edit_transaction" else "Invoices"
@@ -1893,25 +2310,25 @@ async def callback_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                              "row_number":params.get("row_number"),
                              "changes":params.get("changes",{}),
                              "description":data.get("preview","")}
-                msg2 = apply_edit(edit_data)
+                msg2 = await _locked_write(apply_edit, edit_data)
             elif action == "delete_transaction":
                 edit_data = {"type":"edit","sheet":"Transactions",
                              "action":"delete",
                              "row_number":params.get("row_number"),
                              "changes":{},
                              "description":data.get("preview","")}
-                msg2 = apply_edit(edit_data)
+                msg2 = await _locked_write(apply_edit, edit_data)
             elif action == "delete_invoice":
                 edit_data = {"type":"edit","sheet":"Invoices",
                              "action":"delete",
                              "row_number":params.get("row_number"),
                              "changes":{},
                              "description":data.get("preview","")}
-                msg2 = apply_edit(edit_data)
+                msg2 = await _locked_write(apply_edit, edit_data)
             elif action == "mark_invoice_paid":
                 # Full invoice_update path — creates auto-transaction
                 inv_data = {"new_transactions":[],"invoice_updates":[params],"new_invoices":[]}
-                tx_a, inv_u, inv_a, tx_upd, auto_tx, dups = write_to_excel(inv_data)
+                tx_a, inv_u, inv_a, tx_upd, auto_tx, dups = await _locked_write(write_to_excel, inv_data)
                 msg2 = f"Инвойс обновлён." + (f" Создана транзакция." if auto_tx else "")
             else:
                 msg2 = f"Неизвестное действие: {action}"
@@ -1926,7 +2343,7 @@ async def callback_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Handle /edit command
     if data.get("type") == "edit":
         try:
-            result_text = apply_edit(data)
+            result_text = await _locked_write(apply_edit, data)
         except Exception as e:
             await query.edit_message_text(f"Ошибка редактирования: {e}")
             log.error(f"Edit error: {e}"); return
@@ -1936,7 +2353,7 @@ async def callback_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        tx_a, inv_u, inv_a, tx_upd, auto_tx, dup_warnings = write_to_excel(data)
+        tx_a, inv_u, inv_a, tx_upd, auto_tx, dup_warnings = await _locked_write(write_to_excel, data)
     except Exception as e:
         await query.edit_message_text(f"Ошибка записи в Excel: {e}")
         log.error(f"Excel write error: {e}"); return
@@ -1960,178 +2377,23 @@ async def callback_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await _send_excel_and_backup(ctx.bot, caption="Обновлённый Excel")
 
 
-async def cmd_edit(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    """
-    Universal Excel editing command. Examples:
-      /edit получили 10,000 EUR наличными в Монако
-      /edit поменяй получателя в последней строке на Dubai Insurance
-      /edit статус Dubai Insurance — оплачен 25.02.2026
-      /edit уточни валюту строки 42 — это BHD а не AED
-      /edit удали последнюю строку
-      /edit Шафранов оплачен $14,280 банковским переводом
-    """
-    text = " ".join(ctx.args).strip()
-    if not text:
-        await update.message.reply_text(
-            "Примеры команд:\n\n"
-            "ДОБАВИТЬ:\n"
-            "/edit получили 10,000 EUR наличными в Монако\n"
-            "/edit депозит $50,000 подтверждён агентом сегодня\n"
-            "/edit Шафранов оплачен $14,280 банковским переводом\n\n"
-            "ИЗМЕНИТЬ:\n"
-            "/edit поменяй получателя Dubai Insurance на оплаченный статус\n"
-            "/edit исправь валюту последней строки на AED сумма 19502\n"
-            "/edit статус Шафранов — оплачен 25.02.2026\n\n"
-            "УДАЛИТЬ:\n"
-            "/edit удали последнюю транзакцию\n"
-            "/edit удали последние 2 строки"
-        )
-        return
-
-    # Check if it's a delete command
-    text_lower = text.lower()
-    if any(w in text_lower for w in ["удали", "удалить", "delete"]):
-        n = 1
-        for word in text_lower.split():
-            try: n = int(word); break
-            except: pass
-        n = min(n, 5)
-        if not EXCEL_FILE.exists():
-            await update.message.reply_text("Excel файл не найден.")
-            return
-        wb = load_workbook(EXCEL_FILE)
-        ws = wb["Transactions"]
-        deleted = []
-        for _ in range(n):
-            last = None
-            for row in ws.iter_rows(min_row=5):
-                if row[0].value is not None: last = row[0].row
-            if last:
-                desc = ws.cell(last,3).value or ""
-                amt  = ws.cell(last,6).value or ""
-                ccy  = ws.cell(last,5).value or ""
-                deleted.append(f"{desc} | {amt} {ccy}")
-                ws.delete_rows(last)
-        wb.save(EXCEL_FILE)
-        result = f"Удалено {len(deleted)} строк:\n" + "\n".join(f"- {d}" for d in deleted)
-        await update.message.reply_text(result)
-        await _send_excel_and_backup(ctx.bot, caption="Excel после правки", filename="Agent_after_edit.xlsx")
-        return
-
-    # For all other edits — ask Claude to generate JSON
-    context = load_context()
-
-    # Get current last 5 transactions for context
-    tx_context = ""
-    if EXCEL_FILE.exists():
-        try:
-            wb2 = load_workbook(EXCEL_FILE, data_only=True)
-            ws2 = wb2["Transactions"]
-            rows = [r for r in ws2.iter_rows(min_row=5, values_only=True) if r[0] is not None]
-            tx_context = "Последние транзакции в Excel:\n" + "\n".join(
-                f"  [{r[0]}] {r[1]} | {r[3] or '?'} | {r[5]} {r[4]} | bal={r[10]}"
-                for r in rows[-8:]
-            )
-            inv_rows = [r for r in wb2["Invoices"].iter_rows(min_row=5, values_only=True)
-                       if r[0] is not None and r[6] and "Pending" in str(r[6])]
-            if inv_rows:
-                tx_context += "\n\nPending инвойсы:\n" + "\n".join(
-                    f"  {r[1]} | {r[2]} | {r[4]} {r[3]} | {r[6]}"
-                    for r in inv_rows[:10]
-                )
-        except Exception as e:
-            log.error(f"Excel read for edit: {e}")
-
-    prompt = f"""КОНТЕКСТ ПРОЕКТА:
-{context}
-
-{tx_context}
-
----
-Пользователь хочет внести правку в Excel одной командой:
-"{text}"
-
-Это может быть:
-1. Добавление новой транзакции
-2. Изменение статуса инвойса (если упоминается получатель + "оплачен/paid/исполнен")
-3. Исправление данных существующей записи (валюта, сумма, получатель)
-
-Верни ТОЛЬКО валидный JSON без markdown:
-{{
-  "new_transactions": [
-    {{
-      "date": "DD.MM.YYYY",
-      "type": "Payment|Deposit|Cash Out|Cash In|❓ Unknown",
-      "description": "краткое описание",
-      "payee": "получатель",
-      "ccy": "AED|USD|EUR|CNY|SGD|RUB|INR|BHD",
-      "amount": 0.0,
-      "fx_rate": null,
-      "comm": null,
-      "notes": "добавлено вручную"
-    }}
-  ],
-  "invoice_updates": [
-    {{
-      "invoice_no": "номер или название",
-      "new_status": "✅ Paid|⏳ Pending|⚠ Partial/Check|❓ Clarify",
-      "date_paid": "DD.MM.YYYY",
-      "ref": ""
-    }}
-  ],
-  "new_invoices": [],
-  "balance_reconciliation": {{}},
-  "context_update": "краткая запись для контекста",
-  "summary": "одна строка — что изменили"
-}}
-
-Правила:
-- "получили кэш/наличные" = Cash Out (агент доставил нам)
-- "оплатили/заплатили" = Payment
-- "депозит/отправили агенту" = Deposit
-- "оплачен/paid/исполнен" + название = invoice_updates
-- BALKEMY/TROVECO/RAWRIMA = плательщики, не получатели
-- Дата не указана → сегодня: {datetime.now().strftime("%d.%m.%Y")}
-- Если правка касается существующей записи (не новая) → используй invoice_updates
-- Если нужно добавить новую строку → new_transactions"""
-
-    await update.message.reply_text("Анализирую...")
-
-    try:
-        raw = await ask_claude(prompt, system=(
-            "You are a JSON extraction assistant. "
-            "Return ONLY valid JSON, no markdown, no backticks."
-        ))
-        data = json.loads(_clean_json(raw))
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка анализа: {e}")
-        return
-
-    conf_text = format_confirmation(data)
-    keyboard = _build_confirmation_keyboard(data)
-    save_pending(data)
-    await update.message.reply_text(conf_text, reply_markup=keyboard)
-
-# Keep /add as alias for /edit
-async def cmd_add(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    await cmd_edit(update, ctx)
-
-
-
 async def handle_chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE, user_text: str):
     """Handle free-form user messages as AI conversation."""
-    context    = load_context()
-    excel_sum  = get_excel_summary()
-    history    = load_chat_history()
-    existing_inv = get_existing_invoices_list()
+    context = load_context()
+    history = load_chat_history()
 
-    # Build messages for Claude
-    recent_tx = get_recent_transactions_with_rows(10)
+    # All workbook reads in one threaded closure — they parse the xlsx and
+    # must stay off the event loop (same pattern as _send_report)
+    def _chat_state():
+        return (get_excel_summary(),
+                get_existing_invoices_list(),
+                get_recent_transactions_with_rows(10))
 
-    system_prompt = f"""Ты финансовый ассистент для трекера платежей через агента.
-Отвечай по-русски, кратко и по делу.
+    excel_sum, existing_inv, recent_tx = await asyncio.to_thread(_chat_state)
 
-ТЕКУЩЕЕ СОСТОЯНИЕ EXCEL:
+    # Volatile Excel state goes in its own uncached block after the static
+    # rules — same layout as _build_parse_system_prompt.
+    state = f"""ТЕКУЩЕЕ СОСТОЯНИЕ EXCEL:
 {excel_sum}
 
 ПОСЛЕДНИЕ ТРАНЗАКЦИИ (с номерами строк для редактирования):
@@ -2141,36 +2403,7 @@ async def handle_chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE, user_text:
 {existing_inv}
 
 КОНТЕКСТ ПРОЕКТА:
-{context}
-
-Если пользователь просит ДЕЙСТВИЕ — ответь JSON:
-{{
-  "type": "action",
-  "action": "add_transaction|add_invoice|edit_transaction|edit_invoice|delete_transaction|delete_invoice|mark_invoice_paid",
-  "params": {{...}},
-  "preview": "одна строка — что именно сделаем",
-  "message": "текст ответа пользователю"
-}}
-
-Если просто ВОПРОС — ответь JSON:
-{{
-  "type": "text",
-  "message": "твой ответ"
-}}
-
-ПАРАМЕТРЫ ПО ДЕЙСТВИЯМ:
-
-add_transaction: date, type(Payment|Deposit|Cash Out|Cash In|❓ Unknown), description, payee, ccy, amount, fx_rate(null=из настроек), comm(null), notes, payer(опц.), beneficiary(опц.)
-add_invoice: date, invoice_no, payee, ccy, amount, status(⏳ Pending), notes, beneficiary(опц.)
-edit_transaction: row_number(из списка выше!), changes: {{col_X: value}}
-  Колонки: col_A=Date, col_B=Type, col_C=Desc, col_D=Payee, col_E=CCY, col_F=Amt, col_G=FX, col_L=Notes, col_M=Payer, col_N=Beneficiary
-edit_invoice: row_number(из списка инвойсов!), changes: {{col_X: value}}
-  Колонки: col_A=Date, col_B=InvNo, col_C=Payee, col_D=CCY, col_E=Amt, col_G=Status, col_H=DatePaid, col_I=Ref, col_J=Notes, col_K=Beneficiary
-delete_transaction: row_number
-delete_invoice: row_number
-mark_invoice_paid: invoice_no, new_status("✅ Paid"), date_paid, ref(опц.), swift_amount(опц.), swift_ccy(опц.) — ИСПОЛЬЗУЙ для отметки инвойса оплаченным, создаёт транзакцию автоматически
-
-ВАЖНО: row_number ВСЕГДА берётся из списков выше, никогда не угадывай!"""
+{context}"""
 
     messages = []
     # Add history
@@ -2180,21 +2413,19 @@ mark_invoice_paid: invoice_no, new_status("✅ Paid"), date_paid, ref(опц.),
     messages.append({"role": "user", "content": user_text})
 
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.post(
-                "https://api.anthropic.com/v1/messages",
-                headers={"x-api-key": ANTHROPIC_KEY,
-                         "anthropic-version": "2023-06-01",
-                         "anthropic-beta": "prompt-caching-2024-07-31",
-                         "content-type": "application/json"},
-                json={"model": "claude-opus-4-6", "max_tokens": 1500,
-                      "temperature": 0,
-                      "system": [{"type": "text", "text": system_prompt,
-                                  "cache_control": {"type": "ephemeral"}}],
-                      "messages": messages},
-            )
-            raw = _clean_json(r.json()["content"][0]["text"])
-            data = json.loads(raw)
+        client = _get_claude_client()
+        r = await client.post(
+            "/v1/messages",
+            headers={"anthropic-beta": "prompt-caching-2024-07-31"},
+            json={"model": "claude-opus-4-6", "max_tokens": 1500,
+                  "temperature": 0,
+                  "system": [{"type": "text", "text": _CHAT_RULES,
+                              "cache_control": {"type": "ephemeral"}},
+                             {"type": "text", "text": state}],
+                  "messages": messages},
+        )
+        raw = _clean_json(_json_loads(r.content)["content"][0]["text"])
+        data = _json_loads(raw)
     except Exception as e:
         log.error(f"Chat error: {e}")
         await update.message.reply_text(f"Ошибка: {e}")
@@ -2236,24 +2467,28 @@ async def cmd_delete(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Excel файл не найден.")
         return
 
-    wb = load_workbook(EXCEL_FILE)
-    ws = wb["Transactions"]
-
-    deleted = []
-    for _ in range(n):
-        last = None
-        for row in ws.iter_rows(min_row=5):
-            if row[0].value is not None:
-                last = row[0].row
-        if last:
+    def _delete_last():
+        wb = load_workbook(EXCEL_FILE)
+        ws = wb["Transactions"]
+        out = []
+        # one backward scan instead of a full sheet pass per deleted row
+        last = ws.max_row
+        for _ in range(n):
+            while last >= 5 and ws.cell(last, 1).value is None:
+                last -= 1
+            if last < 5:
+                break
             desc  = ws.cell(last, 3).value or ""
             date  = ws.cell(last, 1).value or ""
             amt   = ws.cell(last, 6).value or ""
             ccy   = ws.cell(last, 5).value or ""
-            deleted.append(f"[{date}] {desc} | {amt} {ccy}")
+            out.append(f"[{date}] {desc} | {amt} {ccy}")
             ws.delete_rows(last)
+            last -= 1
+        _save_wb(wb)
+        return out
 
-    wb.save(EXCEL_FILE)
+    deleted = await _locked_write(_delete_last)
 
     if deleted:
         msg_text = f"Удалено {len(deleted)} строк:\n" + "\n".join(f"- {d}" for d in deleted)
@@ -2288,28 +2523,66 @@ async def cmd_edit(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Excel файл не найден.")
         return
 
-    # Read current Excel state to give Claude context
-    wb_read = load_workbook(EXCEL_FILE, data_only=True)
-    ws_read = wb_read["Transactions"]
-    wi_read = wb_read["Invoices"]
-
-    tx_rows = []
-    for row in ws_read.iter_rows(min_row=5, values_only=True):
-        if row[0] is not None:
-            tx_rows.append(row)
+    # "удали последнюю" doesn't need Claude — resolve the row locally and go
+    # straight to the usual confirmation keyboard.
+    if re.search(r"удали.*последн|delete.*last", text, re.I):
+        def _last_tx():
+            wb_read = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
+            try:
+                last_r, last_vals = None, None
+                for i, row in enumerate(wb_read["Transactions"].iter_rows(min_row=5, values_only=True)):
+                    if row[0] is not None:
+                        last_r, last_vals = i + 5, row
+                return last_r, last_vals
+            finally:
+                wb_read.close()
+
+        last_r, vals = await asyncio.to_thread(_last_tx)
+        if not last_r:
+            await update.message.reply_text("Нет строк для удаления.")
+            return
 
-    inv_rows = []
-    for row in wi_read.iter_rows(min_row=5, values_only=True):
-        if row[0] is not None or row[1] is not None:
-            inv_rows.append(row)
+        desc = f"удалить последнюю транзакцию: [{vals[0]}] {vals[2] or ''} | {vals[5]} {vals[4]}"
+        save_pending({"type": "edit", "sheet": "Transactions", "action": "delete",
+                      "row_number": last_r, "changes": {}, "description": desc})
+        keyboard = _build_confirmation_keyboard({"type": "edit"})
+        await update.message.reply_text(
+            f"Команда: {desc}\n\n"
+            f"Лист: Transactions\n"
+            f"Строка: {last_r}\n"
+            f"Действие: delete\n"
+            f"Изменения:\nудаление строки",
+            reply_markup=keyboard)
+        return
 
-    # Format for Claude
+    # Read current Excel state to give Claude context
+    def _read_rows():
+        wb_read = load_workbook(EXCEL_FILE, read_only=True, data_only=True)
+        try:
+            txs, invs = [], []
+            for row in wb_read["Transactions"].iter_rows(min_row=5, values_only=True):
+                if row[0] is not None:
+                    txs.append(row)
+            for row in wb_read["Invoices"].iter_rows(min_row=5, values_only=True):
+                if row[0] is not None or row[1] is not None:
+                    invs.append(row)
+            return txs, invs
+        finally:
+            wb_read.close()
+
+    tx_rows, inv_rows = await asyncio.to_thread(_read_rows)
+
+    # Format for Claude. Cap transactions at the last 50 — the prompt shouldn't
+    # grow with the sheet, and edits almost always target recent rows.
+    tx_off = max(len(tx_rows) - 50, 0)
     tx_text = "\n".join(
         f"Row {i+5}: [{r[0]}] {r[1]} | {r[3] or '?'} | {r[5]} {r[4]} | bal={r[10]} | notes={r[11] or ''}" +
         (f" | payer={r[12]}" if len(r) > 12 and r[12] else "") +
         (f" | for={r[13]}" if len(r) > 13 and r[13] else "")
-        for i, r in enumerate(tx_rows)
+        for i, r in enumerate(tx_rows) if i >= tx_off
     )
+    if tx_off:
+        tx_text = f"(показаны последние 50 из {len(tx_rows)} строк)\n" + tx_text
     inv_text = "\n".join(
         f"Row {i+5}: [{r[0]}] inv={r[1]} | {r[2]} | {r[4]} {r[3]} | status={r[6]} | paid={r[7]}" +
         (f" | for={r[10]}" if len(r) > 10 and r[10] else "")
@@ -2329,53 +2602,15 @@ async def cmd_edit(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 Колонки: A=Date, B=InvNo, C=Payee, D=CCY, E=Amount, F=USD, G=Status, H=DatePaid, I=Ref, J=Notes, K=Beneficiary
 {inv_text}
 
-КОМАНДА ПОЛЬЗОВАТЕЛЯ: {text}
-
-Верни ТОЛЬКО валидный JSON без markdown:
-{{
-  "sheet": "Transactions|Invoices",
-  "action": "update|delete",
-  "row_number": 42,
-  "changes": {{
-    "col_A": null,
-    "col_B": null,
-    "col_C": null,
-    "col_D": null,
-    "col_E": null,
-    "col_F": null,
-    "col_G": null,
-    "col_H": null,
-    "col_I": null,
-    "col_J": null,
-    "col_K": null,
-    "col_L": null
-  }},
-  "description": "одна строка — что именно меняем и почему"
-}}
-
-Правила:
-- row_number: точный номер строки Excel (начиная с 5)
-- changes: только те колонки которые нужно изменить, остальные null
-- action=delete: удалить строку целиком
-- Если команда непонятна или строка не найдена — верни {{"error": "описание проблемы"}}
-- Не пересчитывай баланс — только меняй указанные поля
-
-КОЛОНКИ Transactions: col_A=Date, col_B=Type, col_C=Description, col_D=Payee, col_E=CCY, col_F=Amount(число), col_G=FX, col_H=GrossUSD, col_I=Comm%, col_J=NetUSD, col_K=Balance, col_L=Notes, col_M=Payer, col_N=Beneficiary
-КОЛОНКИ Invoices: col_A=Date, col_B=InvNo, col_C=Payee, col_D=CCY(валюта), col_E=Amount(ЧИСЛО!), col_F=USD_equiv, col_G=Status, col_H=DatePaid, col_I=Ref, col_J=Notes, col_K=Beneficiary
-
-ВАЖНО для Invoices:
-- col_D = валюта (AED/USD/EUR/etc) — СТРОКА
-- col_E = сумма — ЧИСЛО (например 242022.05, не "AED"!)
-- Никогда не пиши валюту в col_E — только число
-- Payer/Beneficiary: наши юрлица (RAWRIMA FZCO, BALKEMY GENERAL TRADING, TROVECO DMCC, ELITESPHERE PTE LTD, NEXUS MARINE PTE LTD, GORNIK TRADING LTD и др.)"""
+КОМАНДА ПОЛЬЗОВАТЕЛЯ: {text}"""
 
     await update.message.reply_text("Анализирую команду...")
 
     try:
-        raw = await ask_claude(prompt, system=(
-            "You are a JSON assistant. Return ONLY valid JSON, no markdown, no backticks."
-        ))
-        data = json.loads(_clean_json(raw))
+        raw = await ask_claude(prompt, system=[
+            {"type": "text", "text": _EDIT_RULES, "cache_control": {"type": "ephemeral"}},
+        ])
+        data = _json_loads(_clean_json(raw))
     except Exception as e:
         await update.message.reply_text(f"Ошибка анализа: {e}")
         return
@@ -2409,7 +2644,7 @@ async def cmd_edit(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(confirm_text, reply_markup=keyboard)
 
 async def cmd_balance(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    result = get_balance_from_excel()
+    result = await asyncio.to_thread(get_balance_from_excel)
     if result:
         bal, date = result
         await update.message.reply_text(
@@ -2418,7 +2653,7 @@ async def cmd_balance(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Баланс не найден. Попробуй /update")
 
 async def cmd_pending(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    pending, usd_total, tbc_count = get_pending_invoices()
+    pending, usd_total, tbc_count = await asyncio.to_thread(get_pending_invoices)
     tbc_note = f"\n(+ {tbc_count} инвойс(ов) с суммой TBC)" if tbc_count else ""
     text = (f"ОЖИДАЮТ ОПЛАТЫ ({len(pending)}):\n\n" +
             ("\n".join(pending) if pending else "нет") +
@@ -2426,7 +2661,7 @@ async def cmd_pending(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 async def cmd_unknown(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    unknowns = get_unknown_transactions()
+    unknowns = await asyncio.to_thread(get_unknown_transactions)
     text = f"НЕИЗВЕСТНЫЕ ТРАНЗАКЦИИ ({len(unknowns)}):\n\n" + (
         "\n".join(unknowns) if unknowns else "нет — хорошо!")
     await update.message.reply_text(text)
@@ -2451,7 +2686,7 @@ async def cmd_excel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if EXCEL_FILE.exists():
         await ctx.bot.send_document(
             chat_id=MY_CHAT_ID,
-            document=EXCEL_FILE.open("rb"),
+            document=io.BytesIO(await asyncio.to_thread(get_excel_bytes)),
             filename="Agent_Model.xlsx",
             caption="Актуальный Excel"
         )
@@ -2606,9 +2841,13 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             if HAS_PDF and len(raw_bytes) < 10 * 1024 * 1024:
                 try:
                     buf.seek(0)
-                    reader = PdfReader(buf)
-                    pages_text = [p.extract_text() or "" for p in reader.pages]
-                    pdf_text = "\n".join(pages_text)[:3000]
+
+                    def _extract_pdf():
+                        reader = PdfReader(buf)
+                        return "\n".join(p.extract_text() or "" for p in reader.pages)
+
+                    # pure-Python parse, CPU-bound — keep it off the event loop
+                    pdf_text = (await asyncio.to_thread(_extract_pdf))[:3000]
                 except Exception:
                     pass  # b64 native path will handle it
 
@@ -2624,7 +2863,9 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if img_b64:
         entry["img_b64"]   = img_b64
         entry["img_media"] = img_media
-    save_message(entry)
+    # Entries with base64 PDF/photo payloads can run to megabytes — keep the
+    # disk append off the event loop
+    await asyncio.to_thread(save_message, entry)
 
     preview = text[:60] + ("…" if len(text) > 60 else "")
     parts   = [f"от {sender}"] if sender else []
@@ -2654,7 +2895,7 @@ async def _send_report(bot: Bot, triggered_manually=False):
     if msgs:
         try:
             data    = await parse_messages(_fmt(msgs))
-            tx_a, inv_u, inv_a, tx_upd, auto_tx, dup_warnings = write_to_excel(data)
+            tx_a, inv_u, inv_a, tx_upd, auto_tx, dup_warnings = await _locked_write(write_to_excel, data)
             if data.get("context_update"):
                 update_context_after_update(data["context_update"])
             if tx_a + inv_u + inv_a > 0:
@@ -2665,10 +2906,17 @@ async def _send_report(bot: Bot, triggered_manually=False):
             log.error(f"Auto-update error: {e}")
             updates_text = f"(Ошибка автообновления: {e})\n\n"
 
-    result  = get_balance_from_excel()
+    # One workbook parse and one sheet pass for the whole report state
+    result, (pending, usd_total, tbc_count), unknown = await asyncio.to_thread(snapshot_excel)
     bal_str = f"${result[0]:,.2f} USD (запись: {result[1]})" if result else "нет данных"
-    pending, usd_total, tbc_count = get_pending_invoices()
-    unknown = get_unknown_transactions()
+
+    # Quiet morning: no queued messages, nothing pending, nothing unknown —
+    # send a one-liner instead of the full report + Excel upload
+    if not msgs and not pending and not unknown and not triggered_manually:
+        await bot.send_message(
+            chat_id=MY_CHAT_ID,
+            text=f"ОТЧЁТ — {today}\n\nБАЛАНС: {bal_str}\n\nИзменений нет.")
+        return
     tbc_note = f"\n  (+ {tbc_count} инвойс(ов) с суммой TBC — не включены)" if tbc_count else ""
     pending_total_str = f"\nИТОГО К ОПЛАТЕ: ~${usd_total:,.0f} USD{tbc_note}"
 
@@ -2691,12 +2939,18 @@ async def morning_job(ctx: ContextTypes.DEFAULT_TYPE):
 # ── Main ──────────────────────────────────────────────────────────────────────
 def main():
     Path("data").mkdir(exist_ok=True)
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    # Explicit pool sizes: morning report fires send_message + send_document
+    # back-to-back and the PTB defaults can hit pool-timeout under bursts.
+    # Excel uploads get a generous media write timeout.
+    app = (Application.builder().token(BOT_TOKEN)
+           .connection_pool_size(32).pool_timeout(30)
+           .get_updates_connection_pool_size(4).get_updates_pool_timeout(30)
+           .media_write_timeout(120)
+           .post_init(post_init).post_shutdown(post_shutdown).build())
     for cmd, fn in [
         ("start", cmd_start), ("update", cmd_update),
         ("edit", cmd_edit),
         ("delete", cmd_delete),
-        ("edit", cmd_edit),
         ("balance", cmd_balance), ("pending", cmd_pending),
         ("unknown", cmd_unknown), ("summary", cmd_summary),
         ("excel", cmd_excel), ("upload", cmd_upload), ("context", cmd_context), ("clear", cmd_clear)
@@ -2711,7 +2965,7 @@ def main():
 async def _store_backup_file_id(bot, file_id: str):
     """Persist Excel file_id in bot description (stored on Telegram servers, survives Railway restarts)."""
     try:
-        payload = json.dumps({"xlsx_fid": file_id, "ts": datetime.now().strftime("%d.%m.%Y")})
+        payload = _json_dumps({"xlsx_fid": file_id, "ts": datetime.now().strftime("%d.%m.%Y")})
         await bot.set_my_description(description=payload)
         log.info(f"Backup file_id stored in bot description: {file_id[:24]}…")
     except Exception as e:
@@ -2726,7 +2980,7 @@ async def restore_excel_from_telegram(app):
         if not desc:
             log.info("restore_excel: no backup description found — using local file")
             return
-        state = json.loads(desc)
+        state = _json_loads(desc)
         file_id = state.get("xlsx_fid")
         if not file_id:
             log.info("restore_excel: no xlsx_fid in description — using local file")
@@ -2749,7 +3003,7 @@ async def _send_excel_and_backup(bot, caption: str, filename: str = None):
     try:
         sent = await bot.send_document(
             chat_id=MY_CHAT_ID,
-            document=EXCEL_FILE.open("rb"),
+            document=io.BytesIO(await asyncio.to_thread(get_excel_bytes)),
             filename=filename,
             caption=caption,
         )
@@ -2763,5 +3017,11 @@ async def post_init(app):
     await restore_excel_from_telegram(app)
     _ensure_settings_usdt()
 
+
+async def post_shutdown(app):
+    """Close the shared Claude HTTP client on bot shutdown."""
+    if _claude_client is not None:
+        await _claude_client.aclose()
+
 if __name__ == "__main__":
     main()
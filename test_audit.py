@@ -369,13 +369,106 @@ class TestInvoiceVariants(unittest.TestCase):
     def test_dash(self):        self.assertIn("inv 5001", self._v("INV 5001-A"))
     def test_em_dash(self):     self.assertIn("inv 4410", self._v("INV 4410 — renewal"))
 
+# ═══════════════════════════════════════════════════════════════
+# 10. _check_all_duplicates  (9 tests)
+# ═══════════════════════════════════════════════════════════════
+class TestCheckAllDuplicates(unittest.TestCase):
+    def _ws(self, rows):
+        """rows: list of (date, type, payee, ccy, amount) starting at row 5."""
+        from openpyxl import Workbook
+        wb = Workbook(); ws = wb.active; ws.title = "Transactions"
+        for i, (dt, tp, payee, ccy, amt) in enumerate(rows):
+            r = 5 + i
+            ws.cell(r, 1, dt); ws.cell(r, 2, tp); ws.cell(r, 3, f"{tp} test")
+            ws.cell(r, 4, payee); ws.cell(r, 5, ccy); ws.cell(r, 6, amt)
+        return ws
+
+    def test_exact_pair_flagged(self):
+        ws = self._ws([("01.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("03.03.2025", "Payment", "Maximus Way", "USD", 1000.0)])
+        flags = bot._check_all_duplicates(ws)
+        self.assertEqual([(f[0], f[1]) for f in flags], [(5, 6)])
+    def test_within_1pct_flagged(self):
+        ws = self._ws([("01.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("03.03.2025", "Payment", "Maximus Way", "USD", 1009.0)])
+        self.assertEqual(len(bot._check_all_duplicates(ws)), 1)
+    def test_over_1pct_not_flagged(self):
+        ws = self._ws([("01.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("03.03.2025", "Payment", "Maximus Way", "USD", 1015.0)])
+        self.assertEqual(bot._check_all_duplicates(ws), [])
+    def test_within_10_days_flagged(self):
+        ws = self._ws([("01.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("08.03.2025", "Payment", "Maximus Way", "USD", 1000.0)])
+        self.assertEqual(len(bot._check_all_duplicates(ws)), 1)
+    def test_beyond_10_days_not_flagged(self):
+        ws = self._ws([("01.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("13.03.2025", "Payment", "Maximus Way", "USD", 1000.0)])
+        self.assertEqual(bot._check_all_duplicates(ws), [])
+    def test_diff_ccy_not_flagged(self):
+        ws = self._ws([("01.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("03.03.2025", "Payment", "Maximus Way", "AED", 1000.0)])
+        self.assertEqual(bot._check_all_duplicates(ws), [])
+    def test_no_payee_token_overlap(self):
+        ws = self._ws([("01.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("03.03.2025", "Payment", "Dubai Insurance", "USD", 1000.0)])
+        self.assertEqual(bot._check_all_duplicates(ws), [])
+    def test_min_new_row_skips_old_pairs(self):
+        ws = self._ws([("01.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("03.03.2025", "Payment", "Maximus Way", "USD", 1000.0),
+                       ("05.03.2025", "Payment", "Maximus Way", "USD", 1000.0)])
+        flags = bot._check_all_duplicates(ws, min_new_row=7)
+        self.assertEqual([(f[0], f[1]) for f in flags], [(5, 7), (6, 7)])
+    def test_cash_out_ignored(self):
+        ws = self._ws([("01.03.2025", "Cash Out", "Maximus Way", "USD", 1000.0),
+                       ("03.03.2025", "Cash Out", "Maximus Way", "USD", 1000.0)])
+        self.assertEqual(bot._check_all_duplicates(ws), [])
+
+# ═══════════════════════════════════════════════════════════════
+# 11. _last_row_from_marker  (7 tests)
+# ═══════════════════════════════════════════════════════════════
+class TestLastRowFromMarker(unittest.TestCase):
+    def _wb(self, n_rows, marker=None):
+        from openpyxl import Workbook
+        wb = Workbook(); ws = wb.active; ws.title = "Transactions"
+        for i in range(n_rows):
+            ws.cell(5 + i, 1, "01.03.2025"); ws.cell(5 + i, 2, "Payment")
+        s = wb.create_sheet("Settings")
+        if marker is not None: s["Z1"] = marker
+        return wb, ws
+
+    def test_valid_marker(self):
+        wb, ws = self._wb(3, marker=7)
+        self.assertEqual(bot._last_row_from_marker(wb, ws), 7)
+    def test_stale_high_after_delete(self):
+        # marker points past the data — rows were deleted since it was stored
+        wb, ws = self._wb(2, marker=7)
+        self.assertEqual(bot._last_row_from_marker(wb, ws), 6)
+    def test_stale_low_after_external_append(self):
+        # rows added by a hand-edited upload below the marker
+        wb, ws = self._wb(4, marker=6)
+        self.assertEqual(bot._last_row_from_marker(wb, ws), 8)
+    def test_no_marker_falls_back(self):
+        wb, ws = self._wb(3)
+        self.assertEqual(bot._last_row_from_marker(wb, ws), 7)
+    def test_empty_sheet_marker_4(self):
+        wb, ws = self._wb(0, marker=4)
+        self.assertEqual(bot._last_row_from_marker(wb, ws), 4)
+    def test_garbage_marker(self):
+        wb, ws = self._wb(3, marker="oops")
+        self.assertEqual(bot._last_row_from_marker(wb, ws), 7)
+    def test_stored_marker_round_trip(self):
+        wb, ws = self._wb(3)
+        bot._store_row_marker(wb, ws, 7)
+        self.assertEqual(bot._last_row_from_marker(wb, ws), 7)
+
 # ═══════════════════════════════════════════════════════════════
 if __name__ == "__main__":
     loader = unittest.TestLoader()
     suite  = unittest.TestSuite()
     for cls in [TestIsAgentCompany, TestParseDate, TestCleanJson, TestGetComm,
                 TestIsDuplicateTx, TestDedupTransactions, TestExcelWrite,
-                TestRecalcBalanceChain, TestInvoiceVariants]:
+                TestRecalcBalanceChain, TestInvoiceVariants,
+                TestCheckAllDuplicates, TestLastRowFromMarker]:
         suite.addTests(loader.loadTestsFromTestCase(cls))
     result = unittest.TextTestRunner(verbosity=2).run(suite)
     total  = result.testsRun